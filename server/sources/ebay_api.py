@@ -2,274 +2,407 @@
 eBay Browse API connector.
 Adapted from Sourceror project with schema mapping.
 """
+import asyncio
 import httpx
 import base64
+import hashlib
 import os
-from datetime import datetime, timedelta
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # Fall back to stdlib json if orjson isn't installed
+    import json as orjson
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; cache writes go unlocked
+    fcntl = None
+
 from storage.models import (
-    Listing, Source, Condition, ShippingMethod,
-    Price, Shipping, Returns, Seller, Specs, Signals, RawData
+    Listing, Source, Condition, Price, Signals, RawData
+)
+from sources.ebay_parsers import (
+    condition_ids_filter, parse_condition, parse_seller, parse_price_and_shipping,
+    parse_returns, extract_specs
 )
 
 # Load environment variables
 load_dotenv()
 
+# OAuth token shared across processes and restarts, in a per-user cache dir
+_TOKEN_CACHE_PATH = Path(
+    os.getenv("EBAY_TOKEN_CACHE")
+    or Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "browser-shopping-agent" / "ebay_token.json"
+)
+
+# Form body for the client-credentials token request
+_TOKEN_REQUEST_DATA = {
+    "grant_type": "client_credentials",
+    "scope": "https://api.ebay.com/oauth/api_scope",
+}
+
+
+def _read_token_cache() -> dict | None:
+    """Read the token cache, ignoring it unless it is private to this user."""
+    try:
+        fd = os.open(_TOKEN_CACHE_PATH, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        with os.fdopen(fd, "rb") as f:
+            st = os.fstat(f.fileno())
+            # Anyone else who can write this file could plant a token
+            if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o077):
+                return None
+            data = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    
+    return data if isinstance(data, dict) else None
+
 
 class EbayConnector:
     """Connector for eBay Browse API."""
     
     BROWSE_API_URL = "https://api.ebay.com/buy/browse/v1"
+    SEARCH_URL = BROWSE_API_URL + "/item_summary/search"
     AUTH_URL = "https://api.ebay.com/identity/v1/oauth2/token"
     
+    _BASE_SEARCH_HEADERS = {
+        "Content-Type": "application/json",
+        "X-EBAY-C-MARKETPLACE-ID": "EBAY_US",
+    }
+    
+    __slots__ = (
+        "client_id", "client_secret", "_basic_auth_header",
+        "_access_token", "_token_expires", "_rejected_token",
+        "_client", "_loop", "_token_lock",
+    )
+    
     def __init__(self):
         self.client_id = os.getenv("EBAY_CLIENT_ID")
         self.client_secret = os.getenv("EBAY_CLIENT_SECRET")
+        self._basic_auth_header = (
+            "Basic " + base64.b64encode(
+                f"{self.client_id}:{self.client_secret}".encode()
+            ).decode()
+            if self.is_configured else None
+        )
         self._access_token: str | None = None
         self._token_expires: datetime | None = None
+        self._rejected_token: str | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._token_lock = asyncio.Lock()
+        self._load_cached_token()
+    
+    async def __aenter__(self) -> "EbayConnector":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
     
     @property
     def is_configured(self) -> bool:
         """Check if API credentials are configured."""
         return bool(self.client_id and self.client_secret)
     
-    async def _get_access_token(self) -> str | None:
-        """Get OAuth access token, refreshing if needed."""
-        # Check if we have a valid cached token
-        if self._access_token and self._token_expires:
-            if datetime.now() < self._token_expires - timedelta(minutes=5):
-                return self._access_token
-        
-        if not self.is_configured:
-            print("[eBay] API credentials not configured")
-            return None
-        
-        # Request new token
-        credentials = f"{self.client_id}:{self.client_secret}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {encoded_credentials}",
-        }
-        data = {
-            "grant_type": "client_credentials",
-            "scope": "https://api.ebay.com/oauth/api_scope",
-        }
-        
-        try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.post(
-                    self.AUTH_URL,
-                    headers=headers,
-                    data=data
-                )
-                response.raise_for_status()
-                token_data = response.json()
-                
-            self._access_token = token_data.get("access_token")
-            expires_in = token_data.get("expires_in", 7200)
-            self._token_expires = datetime.now() + timedelta(seconds=expires_in)
-            
-            return self._access_token
-            
-        except httpx.HTTPError as e:
-            print(f"[eBay] OAuth error: {e}")
-            return None
+    def _bind_to_running_loop(self) -> None:
+        """Reset loop-bound state when used from a different event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Pooled connections and lock waiters belong to the old loop
+            # (e.g. repeated asyncio.run() calls in scripts or tests)
+            self._loop = loop
+            self._client = None
+            self._token_lock = asyncio.Lock()
     
-    def _parse_condition(self, item: dict) -> Condition:
-        """Parse condition from eBay item data."""
-        condition = item.get("condition", "")
-        condition_id = item.get("conditionId", "")
-        
-        if isinstance(condition, dict):
-            condition = condition.get("conditionDisplayName", "").lower()
-        else:
-            condition = str(condition).lower()
-        
-        if "new" in condition or condition_id in ["1000", "1500"]:
-            return Condition.NEW
-        elif "refurbished" in condition or "renewed" in condition or condition_id in ["2000", "2010", "2020", "2030"]:
-            return Condition.REFURB
-        elif condition_id in ["3000", "4000", "5000", "6000", "7000"]:
-            return Condition.USED
-        elif "used" in condition or "pre-owned" in condition:
-            return Condition.USED
-        
-        return Condition.UNKNOWN
+    def _get_client(self) -> httpx.AsyncClient:
+        """Get the shared HTTP client, creating it on first use."""
+        self._bind_to_running_loop()
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=30,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+            )
+        return self._client
     
-    def _parse_price(self, item: dict) -> tuple[float, float | None]:
-        """Parse price and shipping from eBay item."""
-        price_info = item.get("price", {})
-        price = float(price_info.get("value", 0))
-        
-        shipping_options = item.get("shippingOptions", [])
-        if shipping_options:
-            shipping_cost_info = shipping_options[0].get("shippingCost", {})
-            shipping = float(shipping_cost_info.get("value", 0))
-        else:
-            shipping = None
-        
-        return price, shipping
+    async def aclose(self) -> None:
+        """Close the shared HTTP client; call on application shutdown."""
+        if self._client:
+            await self._client.aclose()
+            self._client = None
     
-    def _parse_seller(self, item: dict) -> Seller:
-        """Parse seller information."""
-        seller_data = item.get("seller", {})
-        
-        feedback_percentage = seller_data.get("feedbackPercentage")
-        rating = float(feedback_percentage) if feedback_percentage else None
-        
-        feedback_score = seller_data.get("feedbackScore")
-        reviews = int(feedback_score) if feedback_score else None
-        
-        return Seller(
-            name=seller_data.get("username"),
-            rating=rating,
-            reviews=reviews,
-            is_official=seller_data.get("sellerAccountType") == "BUSINESS"
+    def _has_valid_token(self) -> bool:
+        """Check if the cached token is still valid for at least 5 minutes."""
+        return bool(
+            self._access_token and self._token_expires
+            and datetime.now(timezone.utc) < self._token_expires - timedelta(minutes=5)
         )
     
-    def _parse_shipping(self, item: dict) -> Shipping:
-        """Parse shipping information."""
-        shipping_options = item.get("shippingOptions", [])
-        
-        if not shipping_options:
-            return Shipping()
-        
-        shipping_data = shipping_options[0]
-        
-        shipping_cost_info = shipping_data.get("shippingCost", {})
-        cost = float(shipping_cost_info.get("value", 0)) if shipping_cost_info else None
-        
-        min_days = shipping_data.get("minEstimatedDeliveryDays")
-        max_days = shipping_data.get("maxEstimatedDeliveryDays")
-        eta = int((min_days + max_days) / 2) if min_days and max_days else min_days or max_days
+    def _load_cached_token(self) -> None:
+        """Load a token persisted by this or a sibling process, if any."""
+        if not self.is_configured:
+            return
         
-        shipping_type = shipping_data.get("shippingServiceCode", "").lower()
-        method = ShippingMethod.UNKNOWN
-        if "expedited" in shipping_type or "express" in shipping_type:
-            method = ShippingMethod.EXPEDITED
-        elif "standard" in shipping_type or "economy" in shipping_type:
-            method = ShippingMethod.STANDARD
+        data = _read_token_cache()
+        if not data or data.get("client_id") != self.client_id:
+            return
         
-        return Shipping(
-            cost=cost,
-            eta_days=int(eta) if eta else None,
-            method=method
-        )
+        try:
+            # The file may still hold a token the API rejected if it couldn't be removed
+            if data["access_token"] == self._rejected_token:
+                return
+            expires = datetime.fromisoformat(data["expires"])
+            if expires.tzinfo is None:
+                return  # Written by an older version in local time
+            self._access_token = data["access_token"]
+            self._token_expires = expires
+        except (ValueError, KeyError, TypeError):
+            return
     
-    def _parse_returns(self, item: dict) -> Returns:
-        """Parse return policy."""
-        returns_data = item.get("returnTerms", {})
+    def _invalidate_token(self, token: str) -> None:
+        """Forget a token the API rejected, in memory and on disk."""
+        if self._access_token != token:
+            return  # Already replaced by a concurrent refresh
         
-        if not returns_data:
-            return Returns(unknown=True)
+        self._rejected_token = token
+        self._access_token = None
+        self._token_expires = None
         
-        accepted = returns_data.get("returnsAccepted", False)
-        
-        period = returns_data.get("returnPeriod", {})
-        value = period.get("value")
-        unit = period.get("unit", "").upper()
+        # Only remove the cache file if it still holds the rejected token
+        data = _read_token_cache()
+        if data and data.get("access_token") == token:
+            try:
+                _TOKEN_CACHE_PATH.unlink()
+            except OSError:
+                pass
+    
+    def _save_cached_token(self) -> None:
+        """Atomically persist the current token for other processes."""
+        payload = orjson.dumps({
+            "client_id": self.client_id,
+            "access_token": self._access_token,
+            "expires": self._token_expires.isoformat(),
+        })
+        if isinstance(payload, str):  # stdlib json fallback
+            payload = payload.encode()
         
-        window_days = None
-        if value:
-            if unit == "DAY":
-                window_days = int(value)
-            elif unit == "MONTH":
-                window_days = int(value) * 30
+        lock_flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0)
+        try:
+            _TOKEN_CACHE_PATH.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            lock_fd = os.open(_TOKEN_CACHE_PATH.with_suffix(".lock"), lock_flags, 0o600)
+        except OSError as e:
+            print(f"[eBay] Could not cache token: {e}")
+            return
         
-        return Returns(
-            available=accepted,
-            window_days=window_days,
-            unknown=False
-        )
+        try:
+            if fcntl:
+                # Never block the event loop; skip if another worker is writing
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+            
+            # mkstemp gives a fresh 0600 file; os.replace swaps it in atomically
+            fd, tmp_path = tempfile.mkstemp(
+                dir=_TOKEN_CACHE_PATH.parent, prefix=_TOKEN_CACHE_PATH.name, suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, _TOKEN_CACHE_PATH)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            print(f"[eBay] Could not cache token: {e}")
+        finally:
+            os.close(lock_fd)  # Also releases the flock
     
-    def _extract_specs(self, item: dict) -> Specs:
-        """Extract specs from item."""
-        title = item.get("title", "")
+    async def _get_access_token(self) -> str | None:
+        """Get OAuth access token, refreshing if needed."""
+        self._bind_to_running_loop()
         
-        # Try to get first word as brand
-        title_parts = title.split()
-        brand = title_parts[0] if title_parts else None
+        # Check if we have a valid cached token
+        if self._has_valid_token():
+            return self._access_token
         
-        # Extract key terms
-        key_terms = [
-            word.lower() for word in title.replace("-", " ").split()
-            if len(word) > 2
-        ][:10]
+        if not self.is_configured:
+            print("[eBay] API credentials not configured")
+            return None
         
-        return Specs(
-            brand=brand,
-            model=None,  # Would need more parsing
-            key_terms=key_terms
-        )
+        # Only one coroutine refreshes; the rest wait and reuse its token
+        async with self._token_lock:
+            if self._has_valid_token():
+                return self._access_token
+            
+            # Another process may have refreshed since we last looked
+            self._load_cached_token()
+            if self._has_valid_token():
+                return self._access_token
+            
+            # Request new token
+            headers = {
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Authorization": self._basic_auth_header,
+            }
+            
+            try:
+                client = self._get_client()
+                response = await client.post(
+                    self.AUTH_URL,
+                    headers=headers,
+                    data=_TOKEN_REQUEST_DATA
+                )
+                response.raise_for_status()
+                token_data = orjson.loads(response.content)
+                
+                self._access_token = token_data.get("access_token")
+                expires_in = token_data.get("expires_in", 7200)
+                self._token_expires = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+                self._save_cached_token()
+                
+                return self._access_token
+                
+            except httpx.HTTPError as e:
+                print(f"[eBay] OAuth error: {e}")
+                return None
     
-    def _normalize_listing(self, item: dict) -> Listing:
+    def _normalize_listing(self, item: dict, captured_at: str) -> Listing:
         """Convert eBay item to normalized Listing."""
-        price, shipping_cost = self._parse_price(item)
+        # Read each top-level field once and hand the pieces to the parsers
+        g = item.get
+        raw_title = g("title")
+        title = raw_title or ""
+        condition_id = g("conditionId")
+        
+        price, shipping = parse_price_and_shipping(g("price") or {}, g("shippingOptions"))
+        
+        # Fall back to a stable digest of the title so IDs survive restarts
+        item_id = g("itemId")
+        if not item_id:
+            item_id = f"ebay-{hashlib.blake2b(title.encode(), digest_size=8).hexdigest()}"
         
         return Listing(
-            id=item.get("itemId", f"ebay-{hash(item.get('title', ''))}"),
+            id=item_id,
             source=Source.EBAY,
-            title=item.get("title", "Unknown Item"),
-            url=item.get("itemWebUrl", ""),
-            image_url=item.get("image", {}).get("imageUrl"),
+            title="Unknown Item" if raw_title is None else raw_title,
+            url=g("itemWebUrl", ""),
+            image_url=(g("image") or {}).get("imageUrl"),
             price=Price(value=price, currency="USD"),
-            condition=self._parse_condition(item),
-            shipping=self._parse_shipping(item),
-            returns=self._parse_returns(item),
-            seller=self._parse_seller(item),
-            specs=self._extract_specs(item),
+            condition=parse_condition(g("condition", ""), condition_id),
+            shipping=shipping,
+            returns=parse_returns(g("returnTerms")),
+            seller=parse_seller(g("seller") or {}),
+            specs=extract_specs(title),
             signals=Signals(
-                sponsored=item.get("adId") is not None,
-                low_stock=item.get("quantityLimitPerBuyer") is not None
+                sponsored=g("adId") is not None,
+                low_stock=g("quantityLimitPerBuyer") is not None
             ),
             raw=RawData(
-                captured_at=datetime.now().isoformat(),
-                notes=f"conditionId: {item.get('conditionId')}"
+                captured_at=captured_at,
+                notes=f"conditionId: {condition_id}"
             )
         )
     
-    async def search(self, query: str, max_results: int = 15) -> list[Listing]:
-        """Search eBay Browse API."""
-        token = await self._get_access_token()
-        if not token:
-            return []
+    async def search(
+        self,
+        query: str,
+        max_results: int = 15,
+        *,
+        conditions: list[Condition] | None = None,
+        price_range: tuple[float, float] | None = None
+    ) -> list[Listing]:
+        """
+        Search eBay Browse API.
         
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-            "X-EBAY-C-MARKETPLACE-ID": "EBAY_US",
-        }
+        conditions (e.g. [Condition.NEW, Condition.REFURB]) and price_range
+        (min, max in USD) are applied server-side so unwanted items are never
+        transferred. Including Condition.UNKNOWN disables the condition filter.
+        """
+        filters = ["buyingOptions:{FIXED_PRICE}"]  # Exclude auctions
+        if conditions:
+            condition_filter = condition_ids_filter(conditions)
+            if condition_filter:
+                filters.append(condition_filter)
+        if price_range:
+            filters.append(f"price:[{price_range[0]}..{price_range[1]}],priceCurrency:USD")
         
         params = {
             "q": query,
             "limit": min(max_results, 50),
-            "filter": "buyingOptions:{FIXED_PRICE}",  # Exclude auctions
+            "filter": ",".join(filters),
         }
         
-        url = f"{self.BROWSE_API_URL}/item_summary/search"
-        
-        try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(url, headers=headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-            
-            items = data.get("itemSummaries", [])
-            listings = [
-                self._normalize_listing(item) 
-                for item in items[:max_results]
-            ]
+        # A rejected (revoked/reset) token gets one retry with a fresh one
+        for attempt in range(2):
+            token = await self._get_access_token()
+            if not token:
+                return []
             
-            print(f"[eBay] Found {len(listings)} listings for '{query}'")
-            return listings
+            headers = {**self._BASE_SEARCH_HEADERS, "Authorization": f"Bearer {token}"}
             
-        except httpx.HTTPError as e:
-            print(f"[eBay] API error: {e}")
-            return []
+            try:
+                client = self._get_client()
+                response = await client.get(self.SEARCH_URL, headers=headers, params=params)
+                if response.status_code == 401:
+                    self._invalidate_token(token)
+                    if attempt == 0:
+                        print("[eBay] Access token rejected, refreshing")
+                        continue
+                response.raise_for_status()
+                data = orjson.loads(response.content)
+                
+                items = data.get("itemSummaries", [])
+                captured_at = datetime.now().isoformat()
+                normalize = self._normalize_listing
+                listings = [
+                    normalize(item, captured_at)
+                    for item in items[:max_results]
+                ]
+                
+                print(f"[eBay] Found {len(listings)} listings for '{query}'")
+                return listings
+                
+            except httpx.HTTPError as e:
+                print(f"[eBay] API error: {e}")
+                return []
+        
+        return []
+    
+    async def search_many(
+        self,
+        queries: list[str],
+        max_results: int = 15,
+        concurrency: int = 10,
+        *,
+        conditions: list[Condition] | None = None,
+        price_range: tuple[float, float] | None = None
+    ) -> list[list[Listing]]:
+        """Search eBay for several queries concurrently."""
+        # Fetch the token once so all searches share it
+        if not await self._get_access_token():
+            return [[] for _ in queries]
+        
+        sem = asyncio.Semaphore(concurrency)
+        
+        async def _one(query: str) -> list[Listing]:
+            async with sem:
+                return await self.search(
+                    query,
+                    max_results,
+                    conditions=conditions,
+                    price_range=price_range
+                )
+        
+        return list(await asyncio.gather(*(_one(q) for q in queries)))
 
 
-# Singleton instance
+# Singleton instance. It holds a pooled HTTP client for the life of the
+# process; close it from the app's shutdown hook:
+#     await ebay_connector.aclose()
 ebay_connector = EbayConnector()
@@ -0,0 +1,171 @@
+"""
+eBay item parsers.
+Pure functions over Browse API item JSON, kept separate from the
+connector so they can be compiled with mypyc (`mypyc sources/ebay_parsers.py`).
+"""
+from __future__ import annotations
+
+import re
+from typing import Any
+
+from storage.models import (
+    Condition, ShippingMethod, Shipping, Returns, Seller, Specs
+)
+
+# eBay conditionId -> normalized condition
+_COND_ID_MAP = {
+    "1000": Condition.NEW,
+    "1500": Condition.NEW,
+    "2000": Condition.REFURB,
+    "2010": Condition.REFURB,
+    "2020": Condition.REFURB,
+    "2030": Condition.REFURB,
+    "3000": Condition.USED,
+    "4000": Condition.USED,
+    "5000": Condition.USED,
+    "6000": Condition.USED,
+    "7000": Condition.USED,
+}
+
+# Title words of 3+ characters, split on whitespace and hyphens
+_SPEC_TOKEN_RE = re.compile(r"[^\s\-]{3,}")
+
+# shippingServiceCode substrings -> shipping method
+_EXPEDITED_KEYS = ("expedited", "express")
+_STANDARD_KEYS = ("standard", "economy")
+
+
+def condition_ids_filter(conditions: list[Condition]) -> str | None:
+    """
+    Build a Browse API conditionIds filter for normalized conditions.
+    
+    Uses the same ID table as parse_condition. Returns None if UNKNOWN is
+    requested, since items without a known conditionId can't be selected
+    server-side.
+    """
+    wanted = {Condition(condition) for condition in conditions}
+    if Condition.UNKNOWN in wanted:
+        return None
+    
+    ids = [cid for cid, condition in _COND_ID_MAP.items() if condition in wanted]
+    return "conditionIds:{" + "|".join(ids) + "}"
+
+
+def parse_condition(condition: Any, condition_id: Any) -> Condition:
+    """Map eBay condition display data and conditionId to a Condition."""
+    mapped = _COND_ID_MAP.get(str(condition_id))
+    if mapped:
+        return mapped
+    
+    if isinstance(condition, dict):
+        condition = condition.get("conditionDisplayName", "").lower()
+    else:
+        condition = str(condition).lower()
+    
+    if "new" in condition:
+        return Condition.NEW
+    elif "refurbished" in condition or "renewed" in condition:
+        return Condition.REFURB
+    elif "used" in condition or "pre-owned" in condition:
+        return Condition.USED
+    
+    return Condition.UNKNOWN
+
+
+def parse_seller(seller_data: dict[str, Any]) -> Seller:
+    """Build Seller from an eBay seller object."""
+    g = seller_data.get
+    
+    feedback_percentage = g("feedbackPercentage")
+    rating = float(feedback_percentage) if feedback_percentage else None
+    
+    feedback_score = g("feedbackScore")
+    reviews = int(feedback_score) if feedback_score else None
+    
+    return Seller(
+        name=g("username"),
+        rating=rating,
+        reviews=reviews,
+        is_official=g("sellerAccountType") == "BUSINESS"
+    )
+
+
+def parse_price_and_shipping(
+    price_info: dict[str, Any],
+    shipping_options: list[dict[str, Any]] | None
+) -> tuple[float, Shipping]:
+    """Build price and Shipping from eBay price and shippingOptions objects."""
+    price = float(price_info.get("value", 0))
+    
+    if not shipping_options:
+        return price, Shipping()
+    
+    shipping_data = shipping_options[0]
+    
+    shipping_cost_info = shipping_data.get("shippingCost", {})
+    cost = float(shipping_cost_info.get("value", 0)) if shipping_cost_info else None
+    
+    min_days = shipping_data.get("minEstimatedDeliveryDays")
+    max_days = shipping_data.get("maxEstimatedDeliveryDays")
+    eta = (min_days + max_days) // 2 if min_days and max_days else (min_days or max_days)
+    
+    shipping_type = shipping_data.get("shippingServiceCode") or ""
+    if shipping_type:
+        shipping_type = shipping_type.lower()
+        if any(key in shipping_type for key in _EXPEDITED_KEYS):
+            method = ShippingMethod.EXPEDITED
+        elif any(key in shipping_type for key in _STANDARD_KEYS):
+            method = ShippingMethod.STANDARD
+        else:
+            method = ShippingMethod.UNKNOWN
+    else:
+        method = ShippingMethod.UNKNOWN
+    
+    return price, Shipping(
+        cost=cost,
+        eta_days=eta if eta else None,
+        method=method
+    )
+
+
+def parse_returns(returns_data: dict[str, Any] | None) -> Returns:
+    """Build Returns from an eBay returnTerms object."""
+    if not returns_data:
+        return Returns(unknown=True)
+    
+    accepted = returns_data.get("returnsAccepted", False)
+    
+    period = returns_data.get("returnPeriod", {})
+    value = period.get("value")
+    unit = period.get("unit", "").upper()
+    
+    window_days = None
+    if value:
+        if unit == "DAY":
+            window_days = int(value)
+        elif unit == "MONTH":
+            window_days = int(value) * 30
+    
+    return Returns(
+        available=accepted,
+        window_days=window_days,
+        unknown=False
+    )
+
+
+def extract_specs(title: str) -> Specs:
+    """Extract specs from a listing title."""
+    # Try to get first word as brand
+    title_parts = title.split(None, 1)
+    brand = title_parts[0] if title_parts else None
+    
+    # Extract key terms
+    tokens = _SPEC_TOKEN_RE.findall(title)
+    key_terms = [token.lower() for token in tokens[:10]]
+    
+    return Specs(
+        brand=brand,
+        model=None,  # Would need more parsing
+        key_terms=key_terms
+    )
+